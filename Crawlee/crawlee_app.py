@@ -2,22 +2,27 @@ from __future__ import annotations
 import os
 import json
 import asyncio
+import codecs
+import html
+import re
 from dotenv import load_dotenv
 from datetime import timedelta
 from pathlib import Path
 import shutil
 import time
 from typing import Callable, Dict, Any, Optional
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 
 import requests
-from util.random_id_factory import RandomIDFactory, FileMetadata
+from util.random_id_factory import factory, FileMetadata
 from util.htmlfile_writer import process_json_file
+from util.url_registry import UrlRegistry
 from processor.file_processor import (
     FileProcessor,
     get_root_scheme_domain_from_url,
     get_root_domain_from_url,
     get_save_path_from_url,
+    scan_files,
     url_formater,
     get_all_pdfs_from_directory,
     get_all_pdfs_in_temp_directory,
@@ -31,6 +36,7 @@ from crawlee import (
     RequestTransformAction,
     SkippedReason,
 )
+from bs4 import BeautifulSoup
 from crawlee.crawlers import BeautifulSoupCrawler, BeautifulSoupCrawlingContext
 from processor.rag_processor import upload_document
 
@@ -42,6 +48,20 @@ MAX_PAGES = int(os.getenv("MAX_PAGES", 10))
 RAG_API_KEY = os.getenv("RAG_API_KEY", None)
 RAG_HOST = os.getenv("RAG_HOST", None)
 
+# Meta refresh lookup runs on the raw response body rather than the parse
+# tree: the whole <meta> tag, its content attribute, then the URL= target
+META_REFRESH_PATTERN = re.compile(
+    rb"<meta\b[^>]*\shttp-equiv\s*=\s*[\"']?refresh\b[^>]*>", re.I
+)
+META_CONTENT_PATTERN = re.compile(
+    rb"\scontent\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.I
+)
+REFRESH_URL_PATTERN = re.compile(r"url\s*=\s*['\"]?([^'\";]+)", re.I)
+# Markup the parser never treats as tags, a <meta> inside it is not a redirect
+INERT_MARKUP_PATTERN = re.compile(
+    rb"<!--.*?(?:-->|$)|<script\b.*?(?:</script\s*>|$)", re.I | re.S
+)
+
 CSS_TABLE_STYLE = """
         img {
             width: auto;
@@ -61,6 +81,74 @@ CSS_TABLE_STYLE = """
         }
         """
 
+# Collapse the indentation, the style is written into every stored page
+CSS_TABLE_STYLE = re.sub(r"\s+", " ", CSS_TABLE_STYLE).strip()
+
+STYLE_TAG_HTML = f'<style type="text/css">{CSS_TABLE_STYLE}</style>'
+
+# Byte patterns of everything _scrub_and_rewrite edits: inline styles, PDF
+# links, images and site-relative html anchors. Style attributes may have
+# whitespace around the "=", so they are matched with a regex
+STYLE_ATTRIBUTE_PATTERN = re.compile(rb"\sstyle\s*=")
+REWRITE_MARKERS = (b".pdf", b"<img", b".html")
+
+# Encodings whose bytes are already what htmlfile_writer writes out, pages in
+# any other charset go through the parser to get their charset meta rewritten
+UTF8_ENCODINGS = frozenset({"utf-8", "utf-8-sig", "ascii"})
+
+# Original markup is not normalised by the parser, so match the tag in any case
+HEAD_END_PATTERN = re.compile(r"</head>", re.I)
+
+
+def add_table_style(html_content: str) -> str:
+    """Add the CSS_TABLE_STYLE stylesheet to the head section of a page."""
+    head_end = HEAD_END_PATTERN.search(html_content)
+    if head_end:
+        index = head_end.start()
+        return html_content[:index] + STYLE_TAG_HTML + html_content[index:]
+
+    # If there is no head section, create one and add the style
+    return html_content + f"<head>{STYLE_TAG_HTML}</head>"
+
+
+def is_utf8_encoding(encoding: Optional[str]) -> bool:
+    """Return True if a page in this encoding can be stored as it was served."""
+    if encoding is None:
+        return True
+    try:
+        return codecs.lookup(encoding).name in UTF8_ENCODINGS
+    except LookupError:
+        return False
+
+
+def needs_rewrite(lowered_body: bytes) -> bool:
+    """Return True if the lowercased page has markup _scrub_and_rewrite edits."""
+    return any(
+        marker in lowered_body for marker in REWRITE_MARKERS
+    ) or bool(STYLE_ATTRIBUTE_PATTERN.search(lowered_body))
+
+
+def get_meta_refresh_url(body: bytes) -> Optional[str]:
+    """Return the target of a meta refresh redirect in the page, if any."""
+    meta_tag = META_REFRESH_PATTERN.search(body)
+    if not meta_tag:
+        return None
+
+    # Only pay for stripping comments and scripts on pages that may redirect
+    meta_tag = META_REFRESH_PATTERN.search(INERT_MARKUP_PATTERN.sub(b"", body))
+    if not meta_tag:
+        return None
+
+    content = META_CONTENT_PATTERN.search(meta_tag.group(0))
+    if not content:
+        return None
+
+    content = next(group for group in content.groups() if group is not None)
+    refresh_url = REFRESH_URL_PATTERN.search(
+        html.unescape(content.decode("utf-8", errors="replace"))
+    )
+    return refresh_url.group(1).strip() if refresh_url else None
+
 
 class CrawlerApp:
     _instance = None
@@ -79,10 +167,11 @@ class CrawlerApp:
             self.crawler = BeautifulSoupCrawler(
                 max_requests_per_crawl=self.max_pages,
                 request_handler_timeout=timedelta(seconds=30),
+                parser="lxml",
             )
-            self.pdf_urls = {}
-            self.img_urls = {}
-            self.meta_factory = RandomIDFactory()
+            self.pdf_urls = UrlRegistry()
+            self.img_urls = UrlRegistry()
+            self.meta_factory = factory
             CrawlerApp._initialized = True
 
     def getFileMeta(self, url):
@@ -96,26 +185,21 @@ class CrawlerApp:
             "depth", request_options.get("userData", {}).get("depth", 1)
         )
 
-        if self.crawled_count >= self.max_pages:
-            self.crawler.log.info(
-                f"Skipping URL due to page limit ({self.crawled_count} > {self.max_pages}): {request_options['url']}"
-            )
-            return "skip"
-
         if current_depth > self.max_depth:
             self.crawler.log.info(
                 f"Skipping URL due to depth limit ({current_depth} > {self.max_depth}): {request_options['url']}"
             )
             return "skip"
 
+        user_data = request_options.setdefault("userData", {})
+        user_data["depth"] = current_depth
+
         if "/docs" in request_options["url"]:
             request_options["headers"] = HttpHeaders(
                 {"Custom-Header": "value"})
-            request_options.setdefault("userData", {})["depth"] = current_depth
 
         if "/blog" in request_options["url"]:
             request_options["label"] = "BLOG"
-            request_options.setdefault("userData", {})["depth"] = current_depth
 
         if request_options["url"].endswith(".pdf"):
             self.crawler.log.info(
@@ -123,88 +207,98 @@ class CrawlerApp:
             )
             return "skip"
 
-        request_options.setdefault("userData", {})["depth"] = current_depth
         return request_options
 
-    async def push_data_handler(
-        self,
-        context: BeautifulSoupCrawlingContext,
-        dataset_id: str | None = None,
-        metadata: FileMetadata | None = None,
-    ):
-
-        html_content = (
-            context.soup.prettify() if context.soup else str(context.response.body)
-        )
-
-        root_shema_domain = get_root_scheme_domain_from_url(
-            context.request.url)
-
-        # Remove all existing style attributes
-        for tag in context.soup.find_all(True):  # Find all tags
+    def _scrub_and_rewrite(
+        self, soup: BeautifulSoup, url: str
+    ) -> tuple[str, list[str], list[str]]:
+        """
+        Clean up the page tree and serialize it.
+
+        Runs in a worker thread, so it only modifies the given soup and
+        returns the PDF and image URLs found instead of recording them. It
+        does read self.pdf_urls and self.img_urls to skip known URLs while
+        the event loop thread may be adding to them; membership tests and
+        adds on their fingerprint sets are atomic, and a URL added meanwhile
+        is just returned again and ignored by update().
+        """
+        root_shema_domain = get_root_scheme_domain_from_url(url)
+
+        # Walk the tree once: remove style attributes and collect the
+        # anchors and images that need rewriting
+        html_href_tags = []
+        pdf_tags = []
+        img_tags = []
+        for tag in soup.find_all(True):  # Find all tags
             if "style" in tag.attrs:
                 del tag.attrs["style"]  # Remove the style attribute
 
-        # Add the specified CSS style to the head section
-        if context.soup.find("head"):
-            new_style_tag = context.soup.new_tag("style", type="text/css")
-            new_style_tag.string = CSS_TABLE_STYLE
-            context.soup.find("head").append(new_style_tag)
-        else:
-            # If there is no head section, create one and add the style
-            head_tag = context.soup.new_tag("head")
-            new_style_tag = context.soup.new_tag("style", type="text/css")
-            new_style_tag.string = CSS_TABLE_STYLE
-            head_tag.append(new_style_tag)
-            context.soup.append(head_tag)
+            # Only site-relative links are rewritten, so other anchors and
+            # images are not collected at all
+            if tag.name == "a":
+                href = tag.get("href")
+                if not href or not href.startswith("/"):
+                    continue
+                # Classify on the path only, ignoring query and fragment
+                path = urlsplit(href).path.lower()
+                if path.endswith(".pdf"):
+                    pdf_tags.append(tag)
+                elif path.endswith(".html"):
+                    html_href_tags.append(tag)
+            elif tag.name == "img" and tag.get("src", "").startswith("/"):
+                img_tags.append(tag)
 
         # Format html_href_tags URL
-        html_href_tags = [
-            tag
-            for tag in context.soup.find_all("a")
-            if tag.get("href")
-            and tag.get("href").startswith("/")
-            and tag["href"].split("#")[0].split("?")[0].lower().endswith(".html")
-        ]
-
         for html_href_tag in html_href_tags:
             html_href_tag["href"] = root_shema_domain + html_href_tag["href"]
 
         # Format PDF URL
-        pdf_tags = [
-            tag
-            for tag in context.soup.find_all("a")
-            if tag.get("href") and tag["href"].lower().endswith(".pdf")
-        ]
-
+        pdf_urls = []
         if pdf_tags is not None and len(pdf_tags) > 0:
             pdf_base_dir = str(Path(DATA_DIRECTORY, "pdf"))
             # Modify the src attribute of each img tag
-            pdf_urls = url_formater(
-                context.request.url, pdf_tags, pdf_base_dir)
-            for pdf_url in pdf_urls:
-                if pdf_url not in self.pdf_urls:
-                    self.pdf_urls[pdf_url] = pdf_url
+            pdf_urls = url_formater(url, pdf_tags, pdf_base_dir, self.pdf_urls)
 
         # Format Image URL
-        img_tags = context.soup.find_all("img")
+        img_urls = []
         if img_tags is not None and len(img_tags) > 0:
             img_base_dir = str(Path(DATA_DIRECTORY, "img"))
             # Modify the src attribute of each img tag
-            img_urls = url_formater(
-                context.request.url, img_tags, img_base_dir)
-            for img_url in img_urls:
-                if img_url not in self.pdf_urls:
-                    self.img_urls[img_url] = img_url
+            img_urls = url_formater(url, img_tags, img_base_dir, self.img_urls)
 
         # Generate the modified HTML content
-        html_content = str(context.soup)
+        html_content = add_table_style(str(soup))
+
+        return html_content, pdf_urls, img_urls
+
+    async def push_data_handler(
+        self,
+        context: BeautifulSoupCrawlingContext,
+        dataset_id: str | None = None,
+        metadata: FileMetadata | None = None,
+    ):
+
+        body = context.http_response.read()
+        encoding = context.soup.original_encoding
+        if is_utf8_encoding(encoding) and not needs_rewrite(body.lower()):
+            # Nothing in the page needs rewriting, store the original markup
+            html_content = add_table_style(
+                body.decode(encoding or "utf-8", errors="replace")
+            )
+        else:
+            # Tree rewriting and serialization are CPU bound, keep them off
+            # the event loop so other requests keep being served meanwhile
+            html_content, pdf_urls, img_urls = await asyncio.to_thread(
+                self._scrub_and_rewrite, context.soup, context.request.url
+            )
+            self.pdf_urls.update(pdf_urls)
+            self.img_urls.update(img_urls)
 
         data = {
             "url": context.request.url,
             "html": html_content,
             "depth": context.request.user_data.get("depth", 1),
-            "timestamp": asyncio.get_running_loop().time(),
+            "timestamp": time.time_ns(),
         }
 
         await context.push_data(
@@ -218,18 +312,9 @@ class CrawlerApp:
                 context.log.info("Reached maximum page limit, stopping crawl.")
                 return
 
-            meta_refresh_url = None
-            if context.soup:
-                meta_tag = context.soup.find(
-                    "meta", attrs={"http-equiv": lambda x: x and x.lower() == "refresh"}
-                )
-                if meta_tag and "content" in meta_tag.attrs:
-                    content = meta_tag["content"]
-                    parts = content.split(";")
-                    for part in parts:
-                        if part.strip().startswith("URL="):
-                            meta_refresh_url = part.split("=", 1)[1].strip()
-                            break
+            meta_refresh_url = get_meta_refresh_url(
+                context.http_response.read()
+            )
 
             if meta_refresh_url:
                 absolute_url = urljoin(
@@ -279,78 +364,26 @@ class CrawlerApp:
             print(f"Final count: {self.crawled_count} pages crawled")
 
 
-def download_urls(
+async def download_urls(
     app: CrawlerApp,
     processor: FileProcessor,
     urls: list[str],
     save_dir: Optional[str] = None,
 ):
 
-    # Define a simple download funciton and progress callback
-
-    def file_download(url: str, save_path: str) -> bool:
-        """Download a single PDF file with synchronization protection."""
-
-        def progress_callback(url, save_path, status, progress):
-            filename = os.path.basename(save_path) if save_path else "unknown"
-            app.crawler.log.debug(f"{status} on {filename}: {progress:.1f}%")
-
-        try:
-
-            # Check if file already exists to avoid re-downloading
-            if os.path.exists(save_path):
-                if progress_callback:
-                    progress_callback(url, save_path, "already_exists", 0)
-                return True
+    # Define a simple progress callback
 
-            # Stream the download to handle large files efficiently
-            response = processor.session.get(
-                url, stream=True, timeout=processor.timeout
-            )
-            response.raise_for_status()
-
-            # Get file size for progress tracking
-            total_size = int(response.headers.get("content-length", 0))
-            downloaded_size = 0
-
-            # Download in chunks for efficiency
-            chunk_size = 8192  # 8KB chunks
-            with open(save_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-
-                        # Report progress if callback provided
-                        if progress_callback and total_size > 0:
-                            progress = (downloaded_size / total_size) * 100
-                            progress_callback(
-                                url, save_path, "downloading", progress)
-
-            if progress_callback:
-                progress_callback(url, save_path, "completed", 100)
-
-            return True
-
-        except requests.exceptions.RequestException as e:
-            if progress_callback:
-                progress_callback(url, save_path, f"error: {str(e)}", 0)
-            # Clean up partially downloaded file
-            if os.path.exists(save_path):
-                os.remove(save_path)
-            return False
-        except Exception as e:
-            if progress_callback:
-                progress_callback(url, save_path, f"error: {str(e)}", 0)
-            return False
+    def progress_callback(url, save_path, status, progress):
+        filename = os.path.basename(save_path) if save_path else "unknown"
+        app.crawler.log.debug(f"{status} on {filename}: {progress:.1f}%")
 
     # Download multiple PDFs
     app.crawler.log.info(
         f"Starting download of multiple files... size: {len(urls)}")
     start_time = time.time()
 
-    successful = processor.batch_process_files(
-        urls=urls, progress_function=file_download, save_base_path=save_dir
+    successful = await processor.adownload_files(
+        urls=urls, save_base_path=save_dir, progress_callback=progress_callback
     )
 
     end_time = time.time()
@@ -358,18 +391,11 @@ def download_urls(
         f"Downloaded {len(successful)} files in {end_time - start_time:.2f} seconds"
     )
 
-    # Clean up
-    processor.close()
-
 
 def write_output_files(
     app: CrawlerApp, processor: FileProcessor, data_dir: str, target_tag: str
 ):
-    source_urls = []
-    for root, dirs, files in os.walk(data_dir):
-        for file in files:
-            if file.endswith(".json"):
-                source_urls.append(os.path.join(root, file))
+    source_urls = list(scan_files(data_dir, ".json"))
 
     # Define a simple download funciton and progress callback
     # process_json_file(file_path=file, target_tag="html")
@@ -407,8 +433,12 @@ def write_output_files(
     )
     start_time = time.time()
 
+    # Each file is rendered by a wkhtmltopdf process, which is CPU bound, so
+    # run one per core rather than sizing the pool for network downloads
     successful = processor.batch_process_files(
-        urls=source_urls, progress_function=save_processed_json_file
+        urls=source_urls,
+        progress_function=save_processed_json_file,
+        max_workers=os.cpu_count() or 4,
     )
 
     end_time = time.time()
@@ -416,14 +446,12 @@ def write_output_files(
         f"Downloaded {len(successful)} files in {end_time - start_time:.2f} seconds"
     )
 
-    # Clean up
-    processor.close()
 
-
-def turncate_storage(folder_path):
+async def turncate_storage(folder_path):
     try:
-        # shutil.rmtree will delete the directory and all its contents
-        shutil.rmtree(folder_path)
+        # shutil.rmtree will delete the directory and all its contents, run
+        # it in a thread as large storage trees take a while to remove
+        await asyncio.to_thread(shutil.rmtree, folder_path)
         print(f"The folder at {folder_path} has been deleted successfully.")
     except Exception as e:
         print(f"An error occurred while deleting the folder: {e}")
@@ -436,30 +464,39 @@ async def main(base_url: list[str]) -> None:
     processor = FileProcessor(max_workers=10)
 
     # # Truncate the Storage
-    turncate_storage(STORAGE_PATH)
+    await turncate_storage(STORAGE_PATH)
 
     start_urls = base_url
     await app.run(start_urls)
 
-    pdf_urls = list(app.pdf_urls.keys())
+    pdf_urls = list(app.pdf_urls)
     if len(pdf_urls) > 0:
         app.crawler.log.info(
             f"Processing URLs batch download for PDF, size: {len(pdf_urls)}"
         )
         save_dir_pdf = str(DATA_DIRECTORY / "pdf")
-        download_urls(app, processor, save_dir=save_dir_pdf, urls=pdf_urls)
+        await download_urls(app, processor, save_dir=save_dir_pdf, urls=pdf_urls)
 
-    img_urls = list(app.img_urls.keys())
+    img_urls = list(app.img_urls)
     if len(img_urls) > 0:
         app.crawler.log.info(
             f"Processing URLs batch download for Images, size: {len(img_urls)}"
         )
         save_dir_img = str(DATA_DIRECTORY / "img")
-        download_urls(app, processor, save_dir=save_dir_img, urls=img_urls)
+        await download_urls(app, processor, save_dir=save_dir_img, urls=img_urls)
+
+    # Both batches share the processor's connection pool, so it is only
+    # closed once every download is done
+    await processor.close()
 
     app.crawler.log.info("Extracting HTML files ... ")
-    write_output_files(
-        app, processor, data_dir=str(DATA_DIRECTORY / Path("html")), target_tag="html"
+    # Waits on the processor's thread pool, run it off the event loop
+    await asyncio.to_thread(
+        write_output_files,
+        app,
+        processor,
+        data_dir=str(DATA_DIRECTORY / Path("html")),
+        target_tag="html",
     )
 
     app.crawler.log.info(f"Data is saved at: {DATA_DIRECTORY}")
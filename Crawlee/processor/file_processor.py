@@ -1,14 +1,15 @@
+import asyncio
 import os
 from pathlib import Path
 import re
 import shutil
-import threading
+import string
+import aiohttp
 from bs4 import ResultSet
-import requests
+from functools import lru_cache
 from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional, List, Callable
-from urllib.parse import urlparse
+from typing import Container, Iterable, Iterator, Optional, List, Callable
 import time
 
 
@@ -26,14 +27,30 @@ def get_root_domain_from_url(url: str):
     return domain
 
 
+SANITIZE_PATTERN = re.compile(r"[^\w.-]")
+
+# Same substitution as SANITIZE_PATTERN for ASCII input, as a translate table
+SANITIZE_ASCII_TABLE = {
+    code: code
+    if chr(code) in string.ascii_letters + string.digits + "_.-"
+    else ord("_")
+    for code in range(128)
+}
+
+
+@lru_cache(maxsize=8192)
 def sanitize_name(name: str) -> str:
     """Sanitize a string to be safe for filesystem by replacing problematic characters."""
     # Replace non-alphanumeric, dots, hyphens, underscores with underscores
-    return re.sub(r"[^\w.-]", "_", name)
+    if name.isascii():
+        return name.translate(SANITIZE_ASCII_TABLE)
+    # Unicode word characters (e.g. Chinese file names) are kept as they are
+    return SANITIZE_PATTERN.sub("_", name)
 
 
-def get_save_path_from_url(url: str, save_base_path: str) -> str:
-    """Create directory structure based on URL and return full save path."""
+@lru_cache(maxsize=8192)
+def compute_save_path(url: str, save_base_path: str) -> str:
+    """Return the full save path for a URL without touching the filesystem."""
     parsed = urlparse(url)
     domain = parsed.netloc
     path_parts = parsed.path.strip("/").split("/")
@@ -55,54 +72,105 @@ def get_save_path_from_url(url: str, save_base_path: str) -> str:
     else:
         filename = sanitize_name(filename)
 
-    # Create full directory path
     full_dir = os.path.join(save_base_path, domain, *path_parts)
-    os.makedirs(full_dir, exist_ok=True)
 
     return os.path.join(full_dir, filename)
 
 
-def url_formater(url: str, tags: list[str], base_dir: str) -> list[str]:
+def get_save_path_from_url(
+    url: str, save_base_path: str, create_dirs: bool = False
+) -> str:
+    """Return the full save path for a URL, optionally creating its directory."""
+    save_path = compute_save_path(url, save_base_path)
+
+    # Create full directory path
+    if create_dirs:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    return save_path
+
+
+def make_save_dirs(save_paths: Iterable[str]) -> None:
+    """Create the parent directory of every save path, once per directory."""
+    for save_dir in {os.path.dirname(save_path) for save_path in save_paths}:
+        os.makedirs(save_dir, exist_ok=True)
+
+
+def url_formater(
+    url: str,
+    tags: list[str],
+    base_dir: str,
+    known_urls: Optional[Container[str]] = None,
+) -> list[str]:
     parsed = urlparse(url)
     http_scheme = parsed.scheme
     domain = parsed.netloc
+    # Local paths are only computed here; the directories are created by the
+    # downloader, so rewriting a page costs no filesystem calls
+    save_base_path = os.path.abspath(os.path.join(base_dir, domain))
     tag_urls = []
     for tag in tags:
         try:
             if tag.get("src", "").startswith("/"):
                 ori_url = str(tag["src"])
-                new_url = str(
-                    Path(
-                        get_save_path_from_url(ori_url, str(Path(base_dir) / domain))
-                    ).resolve()
+                new_url = os.path.normpath(
+                    get_save_path_from_url(ori_url, save_base_path)
                 )
                 tag["src"] = new_url
                 target_url = http_scheme + "://" + domain + ori_url
-                tag_urls.append(target_url)
+                if known_urls is None or target_url not in known_urls:
+                    tag_urls.append(target_url)
             if tag.get("href", "").startswith("/"):
                 ori_url = str(tag["href"])
-                new_url = str(
-                    Path(
-                        get_save_path_from_url(ori_url, str(Path(base_dir) / domain))
-                    ).resolve()
+                new_url = os.path.normpath(
+                    get_save_path_from_url(ori_url, save_base_path)
                 )
                 tag["href"] = new_url
                 target_url = http_scheme + "://" + domain + ori_url
-                tag_urls.append(target_url)
+                if known_urls is None or target_url not in known_urls:
+                    tag_urls.append(target_url)
         except Exception as e:
             print(f"error in parsing img tag: {e}")
 
     return tag_urls
 
 
+def preallocate_file(f, size: int) -> None:
+    """Reserve size bytes for an open file so it can be laid out contiguously."""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        # Not supported by every filesystem, the write path works without it
+        pass
+
+
+def scan_files(
+    root_dir: str, suffix: str, skip_dirs: tuple[str, ...] = ()
+) -> Iterator[str]:
+    """Recursively yield the paths of files under root_dir ending with suffix."""
+    try:
+        entries = os.scandir(root_dir)
+    except OSError:
+        # Missing, unreadable or non-directory paths are skipped, as os.walk does
+        return
+
+    # DirEntry caches the file type from readdir, so no extra stat per entry
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in skip_dirs:
+                    yield from scan_files(entry.path, suffix, skip_dirs)
+            elif entry.name.endswith(suffix):
+                yield entry.path
+
+
 def get_all_pdfs_in_temp_directory(storage_dir: str):
     pdfs = []
 
     try:
-        for root, dirs, files in os.walk(storage_dir):
-            for file in files:
-                if file.endswith(".pdf"):
-                    pdfs.append(str(Path(storage_dir + "/" + file).resolve()))
+        pdfs = list(scan_files(os.path.abspath(storage_dir), ".pdf"))
         if len(pdfs) == 0:
             return []
     except Exception as e:
@@ -117,16 +185,14 @@ def get_all_pdfs_from_directory(domain_url: str, storage_dir: str):
     pdfs = []
 
     try:
-        for root, dirs, files in os.walk(target_data_dir):
-            for file in files:
-
-                # Skip working directory
-                skip = str(Path(file).parent).endswith("pdf-upload.tmp") or str(
-                    Path(file).parent
-                ).endswith("pdf-upload.done")
-
-                if file.endswith(".pdf") and not skip:
-                    pdfs.append(os.path.join(root, file))
+        # Skip the upload working directories
+        pdfs = list(
+            scan_files(
+                target_data_dir,
+                ".pdf",
+                skip_dirs=("pdf-upload.tmp", "pdf-upload.done"),
+            )
+        )
 
         if len(pdfs) == 0:
             return []
@@ -174,30 +240,64 @@ def set_pdfs_upload_done(urls: list[str], storage_dir: str):
 
 
 class FileProcessor:
-    def __init__(self, max_workers: int = 10, timeout: int = 30):
+    def __init__(
+        self,
+        max_workers: int = 10,
+        timeout: int = 30,
+        keepalive_timeout: int = 60,
+        chunk_size: int = 256 * 1024,
+    ):
         """
-        Initialize the PDF processor with thread pool and synchronization.
+        Initialize the file processor with its thread pool and HTTP session.
 
         Args:
-            max_workers: Maximum number of concurrent download threads
+            max_workers: Maximum number of concurrent downloads and worker threads
             timeout: Request timeout in seconds
+            keepalive_timeout: Seconds an idle pooled connection is kept open
+            chunk_size: Read size in bytes when streaming a download to disk
         """
         self.max_workers = max_workers
         self.timeout = timeout
-        self.download_lock = threading.Lock()
-        self.session = requests.Session()
+        self.keepalive_timeout = keepalive_timeout
+        self.chunk_size = chunk_size
         # Set default headers to mimic a browser
-        self.session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-        )
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+        }
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Return the shared download session, creating it on first use.
+
+        The session is bound to the running event loop, so it is created
+        lazily from the download coroutines rather than in __init__.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                # Bound the connect and each read gap, not the whole transfer,
+                # so large files are not cut off part way
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=self.timeout, sock_read=self.timeout
+                ),
+                # One keep-alive connection per worker, all of which may go to
+                # the same host since a crawl stays on a single site
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_workers,
+                    limit_per_host=self.max_workers,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=300,
+                ),
+            )
+        return self.session
 
     def batch_process_files(
         self,
         urls: List[str],
         progress_function: Callable[[str, str, Optional[Callable]], Optional[bool]],
         save_base_path: Optional[str] = None,
+        max_workers: Optional[int] = None,
     ) -> List[str]:
         """
         Download multiple PDFs concurrently using thread pool.
@@ -206,6 +306,8 @@ class FileProcessor:
             urls: List of URLs to download
             save_base_path: Base directory to save the PDFs
             progress_callback: Optional callback function for progress updates
+            max_workers: Thread pool size for this batch, defaults to the
+                processor's max_workers
 
         Returns:
             List of successfully downloaded file paths
@@ -213,7 +315,9 @@ class FileProcessor:
         successful_processed = []
 
         # Use thread pool for concurrent downloads
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        with ThreadPoolExecutor(
+            max_workers=max_workers or self.max_workers
+        ) as executor:
             # Create a future for each download task
             if save_base_path is None:
                 future_to_url = {
@@ -225,11 +329,16 @@ class FileProcessor:
                 }
 
             if save_base_path is not None:
+                # Build each save path once and reuse it for the result
+                url_to_path = {
+                    url: get_save_path_from_url(url, save_base_path) for url in urls
+                }
+                make_save_dirs(url_to_path.values())
                 future_to_url = {
                     executor.submit(
                         progress_function,
                         url,
-                        get_save_path_from_url(url, save_base_path),
+                        url_to_path[url],
                     ): url
                     for url in urls
                 }
@@ -243,14 +352,127 @@ class FileProcessor:
                         if save_base_path is None:
                             successful_processed.append(url)
                         if save_base_path is not None:
-                            successful_processed.append(
-                                get_save_path_from_url(url, save_base_path)
-                            )
+                            successful_processed.append(url_to_path[url])
                 except Exception as e:
                     raise e
 
         return successful_processed
 
-    def close(self):
+    async def _download(
+        self,
+        url: str,
+        save_path: str,
+        progress_callback: Optional[Callable[[str, str, str, float], None]] = None,
+    ) -> bool:
+        """Download a single file on the shared HTTP session."""
+        try:
+            # Exclusive create doubles as the "already downloaded" check, so
+            # concurrent downloads of the same path need no shared lock
+            f = open(save_path, "xb")
+        except FileExistsError:
+            if progress_callback:
+                progress_callback(url, save_path, "already_exists", 0)
+            return True
+        except Exception as e:
+            if progress_callback:
+                progress_callback(url, save_path, f"error: {str(e)}", 0)
+            return False
+
+        try:
+            with f:
+                # Stream the download to handle large files efficiently
+                async with self.get_session().get(url) as response:
+                    response.raise_for_status()
+
+                    # Get file size for progress tracking
+                    total_size = int(response.headers.get("content-length", 0))
+                    downloaded_size = 0
+
+                    # Download in chunks for efficiency, keeping disk writes
+                    # off the event loop
+                    chunk_size = self.chunk_size
+                    if 0 < total_size <= chunk_size:
+                        # Small files such as images fit in one read, write
+                        # them in a single call instead of the chunk loop
+                        await asyncio.to_thread(f.write, await response.read())
+                    else:
+                        # fallocate is emulated by writing zeros where the
+                        # filesystem lacks it, keep that off the loop too
+                        await asyncio.to_thread(preallocate_file, f, total_size)
+                        reported_progress = 0.0
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            await asyncio.to_thread(f.write, chunk)
+                            downloaded_size += len(chunk)
+
+                            # Report progress if callback provided, at most
+                            # once per percent downloaded
+                            if progress_callback and total_size > 0:
+                                progress = (downloaded_size / total_size) * 100
+                                if progress - reported_progress >= 1:
+                                    reported_progress = progress
+                                    progress_callback(
+                                        url, save_path, "downloading", progress
+                                    )
+
+                        # Content-Length may differ from the decoded body size,
+                        # drop any preallocated space that was not written
+                        await asyncio.to_thread(f.truncate)
+
+            if progress_callback:
+                progress_callback(url, save_path, "completed", 100)
+
+            return True
+
+        except Exception as e:
+            if progress_callback:
+                progress_callback(url, save_path, f"error: {str(e)}", 0)
+            # Clean up the partially downloaded file, otherwise the next run
+            # would take it for a completed download
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            return False
+
+    async def adownload_files(
+        self,
+        urls: List[str],
+        save_base_path: str,
+        progress_callback: Optional[Callable[[str, str, str, float], None]] = None,
+    ) -> List[str]:
+        """
+        Download multiple files concurrently on the event loop.
+
+        Args:
+            urls: List of URLs to download
+            save_base_path: Base directory to save the files
+            progress_callback: Optional callback function for progress updates
+
+        Returns:
+            List of successfully downloaded file paths
+        """
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def bounded_download(url: str, save_path: str) -> bool:
+            async with semaphore:
+                return await self._download(url, save_path, progress_callback)
+
+        # Compute every save path up front and create each directory once,
+        # instead of once per file
+        save_paths = [get_save_path_from_url(url, save_base_path) for url in urls]
+        make_save_dirs(save_paths)
+
+        results = await asyncio.gather(
+            *(
+                bounded_download(url, save_path)
+                for url, save_path in zip(urls, save_paths)
+            )
+        )
+
+        return [
+            save_path for save_path, success in zip(save_paths, results) if success
+        ]
+
+    async def close(self):
         """Clean up resources."""
-        self.session.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
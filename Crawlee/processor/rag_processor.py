@@ -1,9 +1,24 @@
+import os
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
 
 # Suppress only the InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Every upload goes to the same RAG host, share one pooled session so the
+# TCP + TLS connection is reused instead of set up again per document
+UPLOAD_SESSION = requests.Session()
+UPLOAD_ADAPTER = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+)
+UPLOAD_SESSION.mount("http://", UPLOAD_ADAPTER)
+UPLOAD_SESSION.mount("https://", UPLOAD_ADAPTER)
+
 def upload_document(api_key, host_url, file_path, fodler_name, workspace_name):
     """
     Uploads a PDF document to the specified endpoint with authorization.
@@ -31,13 +46,22 @@ def upload_document(api_key, host_url, file_path, fodler_name, workspace_name):
 
     url = f"{host_url}/api/v1/document/upload/{fodler_name}"
     headers = {"accept": "application/json", "Authorization": f"Bearer {api_key}"}
-    data = {"addToWorkspaces": workspace_name}
 
     try:
         with open(file_path, "rb") as f:
-            files = {"file": (file_path, f, "application/pdf")}
-            response = requests.post(
-                url, headers=headers, data=data, files=files, verify=False
+            # Form fields go before the file, as requests sent them, and an
+            # unset workspace is left out, as requests did for a None value
+            fields = {}
+            if workspace_name is not None:
+                fields["addToWorkspaces"] = workspace_name
+            fields["file"] = (os.path.basename(file_path), f, "application/pdf")
+            # Stream the multipart body from disk instead of building it in memory
+            encoder = MultipartEncoder(fields=fields)
+            response = UPLOAD_SESSION.post(
+                url,
+                headers={**headers, "Content-Type": encoder.content_type},
+                data=encoder,
+                verify=False,
             )
         response.raise_for_status()  # Raise error for bad status codes
         return response.json()["success"]
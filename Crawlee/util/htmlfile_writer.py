@@ -1,6 +1,6 @@
 import os
-import json
 from typing import Tuple
+import orjson
 import pdfkit
 
 PDFKIT_CONFIG = pdfkit.configuration(
@@ -22,23 +22,43 @@ PDFKIT_OPTION = {
 
 
 def _save_html_file_from_json(file_path, data, save_path: str = None):
-    chunk_size = 8192  # 8KB chunks
     file_path = save_path or file_path.replace("json", "html")
-    with open(file_path, "wb") as f:
-        # print(f"Writing html file to {file_path} ...")
-        for i in range(0, len(data), chunk_size):
-            chunk = data[i : i + chunk_size].encode(
-                "utf-8"
-            )  # Convert string chunk to bytes
-            f.write(chunk)
+    encoded = data.encode("utf-8")  # Encode the whole page once
+    # Write beside the target and swap it in, so a crash never leaves a
+    # truncated html file behind
+    tmp_file_path = file_path + ".tmp"
+    try:
+        with open(tmp_file_path, "wb") as f:
+            # print(f"Writing html file to {file_path} ...")
+            f.write(encoded)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        # Do not leave the partial temp file in the dataset directory
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
     return file_path
 
 
+def _drop_page_cache(file_path):
+    # Not available on Windows, where the cache is simply left to the OS
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        with open(file_path, "rb") as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        # Only a hint, the html and pdf are already written
+        pass
+
+
 def _save_pdf_file_from_html(file_path, save_path: str = None):
     pdf_file_path = save_path or str(file_path).replace(".html", ".pdf")
     pdfkit.from_file(
         file_path, pdf_file_path, configuration=PDFKIT_CONFIG, options=PDFKIT_OPTION
     )
+    # The html is not read again once rendered, release its cached pages
+    _drop_page_cache(file_path)
     return pdf_file_path
 
 
@@ -55,13 +75,18 @@ def _save_file(file_path, data, save_path: str = None) -> bool:
 def process_json_file(file_path, target_tag, save_path: str = None) -> bool:
     """Process a single JSON file."""
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            data = json.load(file)
+        with open(file_path, "rb") as file:
+            raw = file.read()
+            # Records without the tag key (e.g. dataset metadata) are skipped
+            # without being parsed
+            if f'"{target_tag}"'.encode("utf-8") not in raw:
+                return False
+            data = orjson.loads(raw)
             if target_tag in data:
                 html = str(data[target_tag])
                 if len(html) > 0:
                     return _save_file(file_path, html, save_path)
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         raise (f"Error decoding JSON from {file_path}: {e}")
     except Exception as e:
         raise (f"Error reading {file_path}: {e}")
@@ -1,9 +1,10 @@
-import asyncio
 import hashlib
-from pathlib import Path
+import os
+import threading
+import time
 import uuid
 from typing import Dict, Optional, TypedDict
-from processor.file_processor import get_root_domain_from_url
+from urllib.parse import urlsplit
 
 
 class FileMetadata(TypedDict):
@@ -13,19 +14,10 @@ class FileMetadata(TypedDict):
 
 
 class RandomIDFactory:
-    _instance: Optional["RandomIDFactory"] = None
-    _initialized: bool = False
-
-    def __new__(cls) -> "RandomIDFactory":
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
-
     def __init__(self) -> None:
-        if not RandomIDFactory._initialized:
-            self.url_to_uuid: Dict[str, str] = {}
-            self.metadata: Dict[str, FileMetadata] = {}
-            RandomIDFactory._initialized = True
+        self.url_to_uuid: Dict[str, str] = {}
+        self.metadata: Dict[str, FileMetadata] = {}
+        self.lock = threading.Lock()
 
     def generateuniqueid(self) -> str:
         return str(uuid.uuid4())
@@ -43,39 +35,46 @@ class RandomIDFactory:
             if existing_metadata := self.metadata.get(existing_id):
                 return existing_metadata
 
-        # Generate UUID from URL hash
-        root_domain = get_root_domain_from_url(url)
+        # Generate UUID from URL hash; root domain is the netloc, as in
+        # get_root_domain_from_url
+        root_domain = urlsplit(url).netloc
         url_bytes = url.encode("utf-8")
         hash_bytes = hashlib.sha256(url_bytes).digest()[:16]
-        candidate_uuid = str(Path(root_domain) / str(uuid.UUID(bytes=hash_bytes)))
+        candidate_uuid = os.path.join(root_domain, str(uuid.UUID(bytes=hash_bytes)))
 
-        # Handle collisions
-        max_retries = 10
-        for nonce in range(max_retries + 1):
-            if nonce > 0:
-                modified_url = f"{url}_{nonce}"
-                modified_hash = hashlib.sha256(modified_url.encode("utf-8")).digest()[
-                    :16
-                ]
-                candidate_uuid = str(
-                    Path(root_domain) / str(uuid.UUID(bytes=modified_hash))
-                )
+        # Lookup and insert must not interleave with another thread
+        with self.lock:
+            # Handle collisions
+            max_retries = 10
+            for nonce in range(max_retries + 1):
+                if nonce > 0:
+                    modified_url = f"{url}_{nonce}"
+                    modified_hash = hashlib.sha256(
+                        modified_url.encode("utf-8")
+                    ).digest()[:16]
+                    candidate_uuid = os.path.join(
+                        root_domain, str(uuid.UUID(bytes=modified_hash))
+                    )
 
-            if existing_metadata := self.metadata.get(candidate_uuid):
-                if existing_metadata["url"] == url:
+                if existing_metadata := self.metadata.get(candidate_uuid):
+                    if existing_metadata["url"] == url:
+                        self.url_to_uuid[url] = candidate_uuid
+                        return existing_metadata
+                else:
+                    # Create new entry
+                    metadata_entry: FileMetadata = {
+                        "name": candidate_uuid,
+                        "url": url,
+                        "timestamp": time.monotonic(),
+                    }
                     self.url_to_uuid[url] = candidate_uuid
-                    return existing_metadata
-            else:
-                # Create new entry
-                metadata_entry: FileMetadata = {
-                    "name": candidate_uuid,
-                    "url": url,
-                    "timestamp": asyncio.get_running_loop().time(),
-                }
-                self.url_to_uuid[url] = candidate_uuid
-                self.metadata[candidate_uuid] = metadata_entry
-                return metadata_entry
+                    self.metadata[candidate_uuid] = metadata_entry
+                    return metadata_entry
 
         raise RuntimeError(
             f"Failed to generate unique UUID for URL after {max_retries} retries"
         )
+
+
+# Shared by every caller, import this instead of constructing a new factory
+factory = RandomIDFactory()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+from typing import Iterable, Iterator, List, Set
+import orjson
+import xxhash
+
+
+class UrlRegistry:
+    """
+    Deduplicate URLs by fingerprint instead of keeping every URL string.
+
+    Only the 64-bit xxHash of each URL is held in memory, spread over
+    n_buckets sets so that no single hash table grows with the crawl. The
+    URLs themselves are appended to an anonymous spool file as JSON lines, so
+    a URL containing a newline stays one entry, and read back when the
+    registry is iterated.
+    """
+
+    def __init__(self, n_buckets: int = 1024) -> None:
+        self.n_buckets = n_buckets
+        self.buckets: List[Set[int]] = [set() for _ in range(n_buckets)]
+        self.size = 0
+        self.spool = tempfile.TemporaryFile(mode="w+b")
+
+    def _bucket(self, fingerprint: int) -> Set[int]:
+        return self.buckets[fingerprint % self.n_buckets]
+
+    @staticmethod
+    def _fingerprint(url: str) -> int:
+        # xxhash 4 no longer hashes str, only bytes
+        return xxhash.xxh64_intdigest(url.encode("utf-8"))
+
+    def register(self, url: str) -> bool:
+        """Add a URL, returning True if it had not been registered before."""
+        fingerprint = self._fingerprint(url)
+        bucket = self._bucket(fingerprint)
+        if fingerprint in bucket:
+            return False
+
+        bucket.add(fingerprint)
+        self.spool.write(orjson.dumps(url) + b"\n")
+        self.size += 1
+        return True
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls:
+            self.register(url)
+
+    def __contains__(self, url: str) -> bool:
+        fingerprint = self._fingerprint(url)
+        return fingerprint in self._bucket(fingerprint)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        self.spool.flush()
+        self.spool.seek(0)
+        urls = [orjson.loads(line) for line in self.spool]
+        # Keep appending after the last registered URL
+        self.spool.seek(0, os.SEEK_END)
+        return iter(urls)
+
+    def close(self) -> None:
+        """Release the spool file; the registry cannot be used afterwards."""
+        self.spool.close()
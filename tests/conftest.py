@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pdfkit
+
+# Modules import each other as top-level packages from Crawlee/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Crawlee"))
+
+# Keep crawler storage out of /data while tests run
+os.environ.setdefault("CRAWLEE_STORAGE_DIR", tempfile.mkdtemp(prefix="crawlee-"))
+
+# htmlfile_writer looks up wkhtmltopdf at import time; the smoke tests never
+# render a PDF, so let them import where the binary is not installed
+_pdfkit_configuration = pdfkit.configuration
+
+
+def _configuration(**kwargs):
+    try:
+        return _pdfkit_configuration(**kwargs)
+    except OSError:
+        return None
+
+
+pdfkit.configuration = _configuration
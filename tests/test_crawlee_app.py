@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+import crawlee_app
+from bs4 import BeautifulSoup
+from crawlee.crawlers import BeautifulSoupCrawler
+
+
+def test_crawler_app_is_singleton():
+    app = crawlee_app.CrawlerApp()
+    assert app is crawlee_app.CrawlerApp()
+    assert isinstance(app.crawler, BeautifulSoupCrawler)
+
+
+def test_meta_refresh_url():
+    body = b'<head><META HTTP-EQUIV="Refresh" CONTENT="0; URL=/new.html"></head>'
+    assert crawlee_app.get_meta_refresh_url(body) == "/new.html"
+
+
+def test_meta_refresh_url_ignores_comments_and_scripts():
+    commented = b'<!-- <meta http-equiv="refresh" content="0;URL=/old"> -->'
+    scripted = b'<script>s = "<meta http-equiv=refresh content=0;url=/s>"</script>'
+    assert crawlee_app.get_meta_refresh_url(commented) is None
+    assert crawlee_app.get_meta_refresh_url(scripted) is None
+    assert crawlee_app.get_meta_refresh_url(b"<p>no redirect</p>") is None
+
+
+def test_is_utf8_encoding():
+    assert crawlee_app.is_utf8_encoding(None)
+    assert crawlee_app.is_utf8_encoding("utf-8")
+    assert crawlee_app.is_utf8_encoding("UTF8")
+    assert crawlee_app.is_utf8_encoding("ascii")
+    assert not crawlee_app.is_utf8_encoding("big5")
+    assert not crawlee_app.is_utf8_encoding("gb2312")
+    assert not crawlee_app.is_utf8_encoding("no-such-codec")
+
+
+def test_needs_rewrite():
+    assert not crawlee_app.needs_rewrite(b"<p>plain text, no styling</p>")
+    assert crawlee_app.needs_rewrite(b'<div style="color: red">x</div>')
+    assert crawlee_app.needs_rewrite(b'<div style = "color: red">x</div>')
+    assert crawlee_app.needs_rewrite(b'<div\n\tstyle\n="color: red">x</div>')
+    assert crawlee_app.needs_rewrite(b'<img src="/logo.png">')
+
+
+def store_page(body: bytes) -> str:
+    """Run push_data_handler on a page and return the html it stores."""
+    pushed = []
+
+    async def push_data(data, **kwargs):
+        pushed.append(data)
+
+    context = SimpleNamespace(
+        http_response=SimpleNamespace(read=lambda: body),
+        soup=BeautifulSoup(body, "lxml"),
+        request=SimpleNamespace(url="https://example.com/a.html", user_data={}),
+        push_data=push_data,
+    )
+    asyncio.run(
+        crawlee_app.CrawlerApp().push_data_handler(
+            context=context, metadata={"name": "html/a"}
+        )
+    )
+    return pushed[0]["html"]
+
+
+def test_push_data_handler_stores_plain_page_as_served():
+    body = b"<html><head></head><body><p>plain</p></body></html>"
+    assert store_page(body) == crawlee_app.add_table_style(body.decode())
+
+
+def test_push_data_handler_strips_spaced_style_attributes():
+    body = b'<html><head></head><body><div style = "color: red">x</div></body></html>'
+    html_content = store_page(body)
+    assert "color: red" not in html_content
+    assert "<div>x</div>" in html_content
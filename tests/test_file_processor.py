@@ -0,0 +1,201 @@
+import asyncio
+import gzip
+import os
+import random
+import re
+import string
+from pathlib import Path
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from processor.file_processor import (
+    FileProcessor,
+    get_save_path_from_url,
+    sanitize_name,
+    scan_files,
+)
+
+
+def test_sanitize_name_matches_regex():
+    rng = random.Random(0)
+    samples = ["".join(chr(c) for c in range(128)), "index.html", "a b/c?d=e&f"]
+    samples += [
+        "".join(rng.choice(string.printable) for _ in range(rng.randint(0, 40)))
+        for _ in range(20000)
+    ]
+    for name in samples:
+        assert sanitize_name(name) == re.sub(r"[^\w.-]", "_", name)
+
+
+def test_sanitize_name_keeps_unicode_words():
+    assert sanitize_name("水務署 - 水資源資料.pdf") == "水務署_-_水資源資料.pdf"
+
+
+def test_scan_files(tmp_path):
+    (tmp_path / "a" / "skip").mkdir(parents=True)
+    (tmp_path / "a" / "one.json").write_text("{}")
+    (tmp_path / "a" / "skip" / "two.json").write_text("{}")
+    (tmp_path / "three.json").write_text("{}")
+    (tmp_path / "other.txt").write_text("")
+
+    found = sorted(scan_files(str(tmp_path), ".json", skip_dirs=("skip",)))
+    assert found == [
+        os.path.join(str(tmp_path), "a", "one.json"),
+        os.path.join(str(tmp_path), "three.json"),
+    ]
+
+
+def test_scan_files_skips_paths_it_cannot_list(tmp_path):
+    (tmp_path / "file.json").write_text("{}")
+    assert list(scan_files(str(tmp_path / "missing"), ".json")) == []
+    assert list(scan_files(str(tmp_path / "file.json"), ".json")) == []
+
+
+def run_download_server(routes, test):
+    """Serve routes on a local aiohttp server and run test(server, processor)."""
+
+    async def main():
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_get(path, handler)
+        processor = FileProcessor(max_workers=4, timeout=5, chunk_size=1024)
+        async with TestServer(app) as server:
+            try:
+                return await test(server, processor)
+            finally:
+                await processor.close()
+
+    return asyncio.run(main())
+
+
+def test_download_streams_and_trims_preallocation(tmp_path):
+    body = random.Random(0).randbytes(10000)
+    compressed = gzip.compress(body)
+    # Incompressible data grows under gzip, so the Content-Length the file is
+    # preallocated to is larger than what ends up being written
+    assert len(compressed) > len(body)
+
+    async def handler(request):
+        return web.Response(body=compressed, headers={"Content-Encoding": "gzip"})
+
+    async def test(server, processor):
+        save_path = str(tmp_path / "big.bin")
+        events = []
+        ok = await processor._download(
+            str(server.make_url("/big.bin")),
+            save_path,
+            lambda *args: events.append(args[2]),
+        )
+        return ok, save_path, events
+
+    ok, save_path, events = run_download_server({"/big.bin": handler}, test)
+    assert ok
+    assert Path(save_path).read_bytes() == body
+    assert "downloading" in events
+    assert events[-1] == "completed"
+
+
+def test_download_small_file_in_one_read(tmp_path):
+    async def handler(request):
+        return web.Response(body=b"tiny")
+
+    async def test(server, processor):
+        save_path = str(tmp_path / "tiny.png")
+        events = []
+        ok = await processor._download(
+            str(server.make_url("/tiny.png")),
+            save_path,
+            lambda *args: events.append(args[2]),
+        )
+        return ok, save_path, events
+
+    ok, save_path, events = run_download_server({"/tiny.png": handler}, test)
+    assert ok
+    assert Path(save_path).read_bytes() == b"tiny"
+    # The chunk loop is skipped, so no progress is reported before completion
+    assert events == ["completed"]
+
+
+def test_download_already_exists(tmp_path):
+    save_path = tmp_path / "done.pdf"
+    save_path.write_bytes(b"old")
+    requested = []
+
+    async def handler(request):
+        requested.append(request.path)
+        return web.Response(body=b"new")
+
+    async def test(server, processor):
+        events = []
+        ok = await processor._download(
+            str(server.make_url("/done.pdf")),
+            str(save_path),
+            lambda *args: events.append(args[2]),
+        )
+        return ok, events
+
+    ok, events = run_download_server({"/done.pdf": handler}, test)
+    assert ok
+    assert events == ["already_exists"]
+    assert requested == []
+    assert save_path.read_bytes() == b"old"
+
+
+async def server_error(request):
+    return web.Response(status=500, body=b"broken")
+
+
+async def truncated_body(request):
+    response = web.StreamResponse(headers={"Content-Length": "100000"})
+    await response.prepare(request)
+    await response.write(b"x" * 5000)
+    request.transport.close()
+    return response
+
+
+def test_download_failure_removes_partial_file(tmp_path):
+    async def test(server, processor):
+        results = []
+        for name in ("error.pdf", "cut.pdf"):
+            save_path = str(tmp_path / name)
+            ok = await processor._download(
+                str(server.make_url("/" + name)), save_path
+            )
+            results.append((ok, os.path.exists(save_path)))
+        return results
+
+    results = run_download_server(
+        {"/error.pdf": server_error, "/cut.pdf": truncated_body}, test
+    )
+    assert results == [(False, False), (False, False)]
+
+
+def test_adownload_files_returns_successful_paths_in_order(tmp_path):
+    async def slow(request):
+        # Finish last, the result must still follow the input order
+        await asyncio.sleep(0.2)
+        return web.Response(body=b"slow")
+
+    async def fast(request):
+        return web.Response(body=b"fast")
+
+    async def test(server, processor):
+        urls = [
+            str(server.make_url("/a/slow.pdf")),
+            str(server.make_url("/b/error.pdf")),
+            str(server.make_url("/c/fast.pdf")),
+        ]
+        paths = await processor.adownload_files(urls, str(tmp_path))
+        return urls, paths
+
+    urls, paths = run_download_server(
+        {"/a/slow.pdf": slow, "/b/error.pdf": server_error, "/c/fast.pdf": fast},
+        test,
+    )
+    assert paths == [
+        get_save_path_from_url(urls[0], str(tmp_path)),
+        get_save_path_from_url(urls[2], str(tmp_path)),
+    ]
+    assert [Path(path).read_bytes() for path in paths] == [b"slow", b"fast"]
+    assert not os.path.exists(get_save_path_from_url(urls[1], str(tmp_path)))
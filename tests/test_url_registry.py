@@ -0,0 +1,28 @@
+from util.url_registry import UrlRegistry
+
+
+def test_register_deduplicates():
+    registry = UrlRegistry(n_buckets=4)
+    assert registry.register("https://example.com/a.pdf")
+    assert not registry.register("https://example.com/a.pdf")
+    registry.update(["https://example.com/b.pdf", "https://example.com/水.pdf"])
+    assert "https://example.com/b.pdf" in registry
+    assert "https://example.com/c.pdf" not in registry
+    assert len(registry) == 3
+
+
+def test_iter_keeps_registration_order():
+    registry = UrlRegistry()
+    registry.update(["https://example.com/1", "https://example.com/2"])
+    assert list(registry) == ["https://example.com/1", "https://example.com/2"]
+    registry.register("https://example.com/3")
+    assert list(registry)[-1] == "https://example.com/3"
+
+
+def test_url_with_newline_stays_one_entry():
+    registry = UrlRegistry()
+    registry.register("https://example.com/x\ny.png")
+    assert len(registry) == 1
+    assert list(registry) == ["https://example.com/x\ny.png"]
+    registry.close()
+    assert registry.spool.closed